@@ -1,4 +1,5 @@
-import requests
+import time
+import upstream
 import pandas as pd
 from collections import defaultdict
 from sklearn.preprocessing import StandardScaler
@@ -18,15 +19,20 @@ class BTCAddressVisualization():
 
 
 
-    def __init__(self, addresskey,depth,samplesize):
+    def __init__(self, addresskey,depth,samplesize,budget=None):
         self.address = addresskey
         self.depth = depth
         self.samplesize = samplesize
+        self.budget = budget
+        self.failed = []
+        self.partial = False
+        self.depth_reached = 0
+        self.partial_level = False
 
     #@staticmethod
     def get_wallet_data(self,wallethash):
         wallet_url = 'https://blockchain.info/rawaddr/'+wallethash
-        data = requests.get(wallet_url)
+        data = upstream.get(wallet_url)
         wallet = data.json()
         return pd.DataFrame(wallet)['txs']
 
@@ -75,13 +81,14 @@ class BTCAddressVisualization():
                     try:
                         newdf = self.make_df(newwallet)
                         df = pd.concat([df,newdf.sample(n = min(newdf.shape[0],samplesize))])
-                    except:
-                        pass
+                    except Exception as e:
+                        print('Could not retrieve data from wallet ', newwallet, e)
+                        self.failed.append(newwallet)
             depth -= 1
         return df
     
-    def make_df2(self,address):
-        a = BitcoinAddress(address)
+    def make_df2(self,address,deadline=None):
+        a = BitcoinAddress(address,deadline)
         tx = pd.DataFrame(a.address['txs'])
         n_tx = len(tx)
         LL = [[(tx['inputs'][j][i]['prev_out']['addr'],tx['inputs'][j][i]['prev_out']['value'])
@@ -90,6 +97,12 @@ class BTCAddressVisualization():
                    if 'addr' in tx['out'][j][i].keys()] for j in range(0,n_tx)]
         df = pd.DataFrame([(x[0],x[1],y[0],y[1]) for i in range(len(LL)) for x in LL[i] for y in LLL[i]],
                              columns=['Sender','Sent','Recipient','Received'])
+        # Every output is repeated once per input; Transferred splits it across the inputs
+        # in proportion to their value, so summing it gives the amounts actually moved.
+        totals = [sum(x[1] for x in L) for L in LL]
+        shares = [float(x[1]) / totals[i] if totals[i] > 0 else 1.0 / len(LL[i])
+                  for i in range(len(LL)) for x in LL[i] for y in LLL[i]]
+        df['Transferred'] = df['Received'] * pd.Series(shares, index=df.index, dtype=float)
         df['Scaled_Sent'] = StandardScaler().fit_transform(pd.DataFrame(df['Sent']))
         df['Bitcoin Sent'] = df['Sent'] * 0.00000001
         return df[(df['Sender'] == address) | (df['Recipient'] == address)]
@@ -105,15 +118,70 @@ class BTCAddressVisualization():
                 if not visited[newwallet] and df.shape[0] < 500:
                     visited[newwallet] = True
                     try:
-                        newdf = self.make_df2(newwallet)
+                        with upstream.priority(upstream.BACKGROUND):
+                            newdf = self.make_df2(newwallet)
                         df = pd.concat([df,newdf.sample(n = min(newdf.shape[0],samplesize))])
-                    except:
-                            pass
+                    except Exception as e:
+                        print('Could not retrieve data from wallet ', newwallet, e)
+                        self.failed.append(newwallet)
             depth -= 1
         return df
 
+    def rank_neighbors(self,df,visited):
+        # Unvisited addresses in the newest level, most value moved first, then most edges.
+        value = pd.concat([df.groupby('Sender')['Transferred'].sum(), df.groupby('Recipient')['Transferred'].sum()])
+        degree = pd.concat([df['Sender'].value_counts(), df['Recipient'].value_counts()])
+        ranked = pd.DataFrame({'value':value.groupby(level=0).sum(),
+                               'degree':degree.groupby(level=0).sum()})
+        ranked = ranked[[a not in visited for a in ranked.index]]
+        return ranked.sort_values(['value','degree'], ascending=False).index.tolist()
+
+    def make_df2_anytime(self,wallet,budget,maxdepth,samplesize):
+        # Deepens one level at a time until the budget (in seconds) runs out or maxdepth
+        # is reached, and returns everything gathered so far. self.partial records
+        # whether the crawl was cut short; depth_reached counts only completed levels,
+        # and partial_level whether part of the next one was gathered.
+        deadline = time.monotonic() + budget
+        visited = set([wallet])
+        df = self.make_df2(wallet,deadline)
+        df = df.sample(n = min(df.shape[0],samplesize))
+        level = df
+        self.partial = False
+        self.depth_reached = 0
+        self.partial_level = False
+        while self.depth_reached < maxdepth and not self.partial:
+            newframes = []
+            for newwallet in self.rank_neighbors(level,visited):
+                if time.monotonic() >= deadline:
+                    self.partial = True
+                    break
+                visited.add(newwallet)
+                try:
+                    # Neighbours queue behind the interactive fetches of other requests.
+                    with upstream.priority(upstream.BACKGROUND):
+                        newdf = self.make_df2(newwallet,deadline)
+                    newframes.append(newdf.sample(n = min(newdf.shape[0],samplesize)))
+                except Exception as e:
+                    if time.monotonic() >= deadline:
+                        self.partial = True
+                        break
+                    print('Could not retrieve data from wallet ', newwallet, e)
+                    self.failed.append(newwallet)
+            if not newframes:
+                break
+            level = pd.concat(newframes)
+            df = pd.concat([df,level])
+            if self.partial:
+                self.partial_level = True
+            else:
+                self.depth_reached += 1
+        return df
+
     def networkdf(self):
-        dftoplot =  self.make_df2_ofdepth_sampling(self.address,self.depth,self.samplesize)
+        if self.budget is None:
+            dftoplot =  self.make_df2_ofdepth_sampling(self.address,self.depth,self.samplesize)
+        else:
+            dftoplot =  self.make_df2_anytime(self.address,self.budget,self.depth,self.samplesize)
         dftoplot['origin'] = (dftoplot['Sender'] == self.address).astype(int) |\
             (dftoplot['Recipient'] == self.address).astype(int)
         #dftoplot['isoriginal'] = (dftoplot['Senders'] == self.address).astype(int) |\
@@ -138,8 +206,9 @@ class BTCAddressVisualization():
 
         return renderer.get_plot(graphtoplot).state
 
-    def plot2(self):
-        dftoplot = self.networkdf()
+    def plot2(self,dftoplot=None):
+        if dftoplot is None:
+            dftoplot = self.networkdf()
         nodelist = list(set(dftoplot['Sender'].tolist()+dftoplot['Recipient'].tolist()))
         node_labels = list(map(lambda addr: 1 if addr == self.address else 0, nodelist))
         nodedf = pd.DataFrame({'nodes':nodelist,'label':node_labels})
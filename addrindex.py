@@ -0,0 +1,172 @@
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from addrtrainer import iter_labeled_chunks, load_latest_model, MODEL_DIR
+
+INDEX_DIR = os.environ.get('INDEX_DIR', 'addrindex')
+CHUNKSIZE = 65536
+QUERY_BATCH = 64
+
+
+def _sqdist(Q, V):
+    # Squared euclidean distances between every row of Q and every row of V. The
+    # expansion cancels badly in float32, so it is always done in float64.
+    Q = np.asarray(Q, dtype=np.float64)
+    V = np.asarray(V, dtype=np.float64)
+    return (Q**2).sum(axis=1)[:,None] - 2 * Q.dot(V.T) + (V**2).sum(axis=1)[None,:]
+
+
+class AddressIndex():
+
+    def __init__(self, path=INDEX_DIR):
+        # Everything is memory mapped, so the index can be far larger than RAM and
+        # workers share its pages.
+        load = lambda name: np.load(os.path.join(path, name+'.npy'), mmap_mode='r')
+        self.vectors = load('vectors')
+        self.labels = load('labels')
+        self.sorted_labels = load('sorted_labels')
+        self.sorted_rows = load('sorted_rows')
+        self.offsets = np.array(load('offsets'))
+        self.centroids = np.array(load('centroids'))
+        self.mean, self.scale = np.array(load('scaler'))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean) / self.scale
+
+    def find(self, addresses):
+        # Row of each address in the index, or -1 for addresses it does not hold.
+        width = self.labels.dtype.itemsize
+        encoded = [a.encode() for a in addresses]
+        fits = np.array([len(key) <= width for key in encoded], dtype=bool)
+        keys = np.array(encoded, dtype=self.labels.dtype)
+        pos = np.minimum(np.searchsorted(self.sorted_labels, keys), len(self.sorted_labels) - 1)
+        found = fits & (np.asarray(self.sorted_labels[pos]) == keys)
+        return np.where(found, self.sorted_rows[pos], -1)
+
+    def search(self, X, k=10, nprobe=3):
+        return self.search_vectors(self.transform(np.atleast_2d(X)), k, nprobe)
+
+    def search_vectors(self, Q, k=10, nprobe=3):
+        # Scans the nprobe inverted lists whose centroids are nearest each scaled query
+        # and returns (labels, distances), both of shape (n_queries, k).
+        Q = np.atleast_2d(np.asarray(Q, dtype=np.float64))
+        if Q.shape[0] > QUERY_BATCH:
+            # Bounds the query-by-chunk distance matrices when a whole block is queried.
+            batches = [self.search_vectors(Q[i:i+QUERY_BATCH], k, nprobe)
+                       for i in range(0, Q.shape[0], QUERY_BATCH)]
+            return sum([b[0] for b in batches], []), np.vstack([b[1] for b in batches])
+        nq = Q.shape[0]
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(_sqdist(Q, self.centroids), axis=1)[:,:nprobe]
+        best_d = np.full((nq, k), np.inf)
+        best_i = np.full((nq, k), -1, dtype=np.int64)
+        for lst in np.unique(probes):
+            qi = np.where((probes == lst).any(axis=1))[0]
+            for start in range(self.offsets[lst], self.offsets[lst+1], CHUNKSIZE):
+                stop = min(start + CHUNKSIZE, self.offsets[lst+1])
+                d = np.maximum(_sqdist(Q[qi], np.asarray(self.vectors[start:stop])), 0)
+                ids = np.broadcast_to(np.arange(start, stop), d.shape)
+                d = np.hstack([best_d[qi], d])
+                ids = np.hstack([best_i[qi], ids])
+                rows = np.arange(len(qi))[:,None]
+                top = np.argpartition(d, k-1, axis=1)[:,:k]
+                best_d[qi] = d[rows, top]
+                best_i[qi] = ids[rows, top]
+        # Re-rank the candidates by their exact distances, taken from direct differences.
+        rows = np.arange(nq)[:,None]
+        found = best_i >= 0
+        diff = np.asarray(self.vectors[np.where(found, best_i, 0)], dtype=np.float64) - Q[:,None,:]
+        best_d = np.where(found, (diff**2).sum(axis=2), np.inf)
+        order = np.argsort(best_d, axis=1, kind='mergesort')
+        best_d = best_d[rows, order]
+        best_i = best_i[rows, order]
+        labels = [[self.labels[i].decode() if i >= 0 else None for i in row] for row in best_i]
+        return labels, np.sqrt(best_d)
+
+
+########################
+#### Index Building ####
+########################
+
+def build_index(paths, model, path=INDEX_DIR, chunksize=100000):
+    # Rows are bucketed by their nearest classifier centroid (an inverted file), using
+    # two passes over the feature files so memory stays bounded: the first counts list
+    # sizes, the second writes each row straight into its slot of a memory-mapped array.
+    scaler = model.named_steps['StandardScaler']
+    centroids = model.named_steps['KMeans'].cluster_centers_.astype(np.float32)
+    mean, scale = scaler.mean_, scaler.scale_
+
+    def assigned_chunks():
+        # Only rows that carry their address can be returned as results; files of
+        # bare feature rows are skipped.
+        for labels, X in iter_labeled_chunks(paths, chunksize):
+            if labels is None:
+                continue
+            V = ((X - mean) / scale).astype(np.float32)
+            yield labels, V, np.argmin(_sqdist(V, centroids), axis=1)
+
+    counts = np.zeros(len(centroids), dtype=np.int64)
+    width = 1
+    for labels, V, lists in assigned_chunks():
+        counts += np.bincount(lists, minlength=len(centroids))
+        width = max(width, max(len(l.encode()) for l in labels))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if offsets[-1] == 0:
+        raise ValueError('No address labeled feature rows to index')
+    label_dtype = 'S'+str(width)
+
+    n = int(offsets[-1])
+    parent = os.path.dirname(os.path.abspath(path))
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_addrindex_')
+    vectors = np.lib.format.open_memmap(os.path.join(tmp, 'vectors.npy'), mode='w+',
+                                        dtype=np.float32, shape=(n, centroids.shape[1]))
+    labelarr = np.lib.format.open_memmap(os.path.join(tmp, 'labels.npy'), mode='w+',
+                                         dtype=label_dtype, shape=(n,))
+    cursor = offsets[:-1].copy()
+    for labels, V, lists in assigned_chunks():
+        order = np.argsort(lists, kind='mergesort')
+        lists = lists[order]
+        starts = np.searchsorted(lists, np.arange(len(centroids)))
+        # Slot for each row: its list's cursor plus its rank within the chunk's run of that list.
+        slots = cursor[lists] + np.arange(len(lists)) - starts[lists]
+        vectors[slots] = V[order]
+        labelarr[slots] = np.array([l.encode() for l in labels], dtype=label_dtype)[order]
+        cursor += np.bincount(lists, minlength=len(centroids))
+    vectors.flush()
+    labelarr.flush()
+    # Labels in sorted order, with their rows, let find() binary search for an address.
+    order = np.argsort(labelarr, kind='mergesort')
+    np.save(os.path.join(tmp, 'sorted_labels.npy'), np.asarray(labelarr)[order])
+    np.save(os.path.join(tmp, 'sorted_rows.npy'), order.astype(np.int64))
+    del vectors, labelarr
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp, 'centroids.npy'), centroids)
+    np.save(os.path.join(tmp, 'scaler.npy'), np.vstack([mean, scale]))
+
+    # Readers that already mapped the old index keep their pages until they reopen.
+    if os.path.exists(path):
+        old = tempfile.mkdtemp(dir=parent, prefix='.old_addrindex_')
+        os.rename(path, os.path.join(old, 'index'))
+        os.rename(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp, path)
+    return AddressIndex(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the similar-address index from feature files.')
+    parser.add_argument('paths', nargs='+', help='whitespace separated stats files with the address first')
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+
+    index = build_index(args.paths, load_latest_model(args.model_dir), args.index_dir, args.chunksize)
+    print('Indexed '+str(len(index))+' addresses in '+args.index_dir)
@@ -1,14 +1,14 @@
-import requests
+import upstream
 import pandas as pd
 import numpy as np
 from collections import defaultdict
 
 class BitcoinAddress():
 
-    def __init__(self, addrkey):
+    def __init__(self, addrkey, deadline=None):
         self.addrkey = addrkey
         self.address_url = 'https://blockchain.info/rawaddr/'+self.addrkey
-        data = requests.get(self.address_url)
+        data = upstream.get(self.address_url, deadline=deadline)
         self.address = data.json()
         
     def n_tx(self):
@@ -78,12 +78,9 @@ class BitcoinAddress():
 class BitcoinBlock():
     
     def __init__(self,blockhash):
-        try:
-            latestblock_url = 'https://blockchain.info/rawblock/'+blockhash
-            data = requests.get(latestblock_url)
-            self.block = data.json() 
-        except:
-            print('Could not retrieve block - incorrect block hash?')
+        latestblock_url = 'https://blockchain.info/rawblock/'+blockhash
+        data = upstream.get(latestblock_url)
+        self.block = data.json() 
             
     def get_addresses(self):
         txdata = [dict(self.block['tx'][k]) for k in range(self.block['n_tx'])]
@@ -0,0 +1,188 @@
+import os
+import time
+import pickle
+import argparse
+import pandas as pd
+import numpy as np
+
+from sklearn.pipeline import Pipeline
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+STATNAMES = ['n_tx','tot_received','tot_sent','n_senders','n_receivers','avg_timebtwtx',
+             'max_timebtwtx','min_timebtwtx']
+
+MODEL_DIR = os.environ.get('MODEL_DIR', 'models')
+LATEST = 'LATEST'
+FALLBACK_MODEL = 'kmeans_classifier_addrsample_20.sav'
+
+
+##############################
+#### Feature Store Access ####
+##############################
+
+def iter_labeled_chunks(paths, chunksize=100000):
+    # Feature rows are the whitespace separated output of BitcoinAddress.stats(),
+    # as written by data/blockdataminer.py, optionally preceded by the address itself.
+    # Files without addresses yield None for the labels. Only one chunk is held in
+    # memory at a time.
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open(path) as f:
+            labeled = len(f.readline().split()) > len(STATNAMES)
+        names = ['address']+STATNAMES if labeled else STATNAMES
+        reader = pd.read_csv(path, sep=' ', header=None, names=names,
+                             usecols=range(len(names)), chunksize=chunksize)
+        for chunk in reader:
+            stats = chunk[STATNAMES].apply(pd.to_numeric, errors='coerce').dropna()
+            if stats.shape[0] == 0:
+                continue
+            labels = chunk.loc[stats.index, 'address'].astype(str).tolist() if labeled else None
+            yield labels, stats.values.astype(np.float64)
+
+def iter_feature_chunks(paths, chunksize=100000):
+    for labels, X in iter_labeled_chunks(paths, chunksize):
+        yield X
+
+
+###################################
+#### Incremental Model Fitting ####
+###################################
+
+class AddressClassifierTrainer():
+
+    def __init__(self, n_clusters=20, batch_size=4096, chunksize=100000, n_epochs=3,
+                 random_state=33, model=None):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.chunksize = chunksize
+        self.n_epochs = n_epochs
+        self.random_state = random_state
+        if model is None:
+            self.scaler = StandardScaler()
+            self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                                          random_state=random_state)
+        else:
+            # Continue from a published pipeline so the clusters drift with the data
+            # instead of being relearned from scratch.
+            self.scaler = model.named_steps['StandardScaler']
+            self.kmeans = model.named_steps['KMeans']
+            if not hasattr(self.kmeans, 'partial_fit'):
+                self.kmeans = MiniBatchKMeans(n_clusters=self.kmeans.n_clusters,
+                                              init=self.kmeans.cluster_centers_, n_init=1,
+                                              batch_size=batch_size, random_state=random_state)
+            self.n_clusters = self.kmeans.n_clusters
+        self.n_samples = 0
+
+    def fit_scaler(self, paths):
+        for X in iter_feature_chunks(paths, self.chunksize):
+            self.scaler.partial_fit(X)
+            self.n_samples += X.shape[0]
+        return self
+
+    def fit_kmeans(self, paths):
+        rng = np.random.RandomState(self.random_state)
+        # The first partial_fit call needs at least n_clusters rows to seed the centroids.
+        step = max(self.batch_size, self.n_clusters)
+        pending = None
+        for epoch in range(self.n_epochs):
+            for X in iter_feature_chunks(paths, self.chunksize):
+                X = self.scaler.transform(X)
+                rng.shuffle(X)
+                if pending is not None:
+                    X = np.vstack([pending, X])
+                    pending = None
+                if not hasattr(self.kmeans, 'cluster_centers_') and X.shape[0] < self.n_clusters:
+                    pending = X
+                    continue
+                for start in range(0, X.shape[0], step):
+                    self.kmeans.partial_fit(X[start:start+step])
+        if not hasattr(self.kmeans, 'cluster_centers_'):
+            raise ValueError('Not enough feature rows to fit '+str(self.n_clusters)+' clusters')
+        return self
+
+    def fit(self, paths):
+        return self.fit_scaler(paths).fit_kmeans(paths)
+
+    def pipeline(self):
+        return Pipeline([('StandardScaler',self.scaler),('KMeans',self.kmeans)])
+
+
+###########################
+#### Model Publication ####
+###########################
+
+def _claim_version(model_dir):
+    # Versions are timestamps; a numeric suffix keeps publishes within the same second
+    # apart, and O_EXCL makes the claim atomic between concurrent publishers.
+    stamp = time.strftime('%Y%m%d%H%M%S')
+    n = 0
+    while True:
+        version = stamp if n == 0 else stamp+'_'+str(n)
+        path = os.path.join(model_dir, 'kmeans_classifier_'+version+'.sav')
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return version, path
+        except FileExistsError:
+            n += 1
+
+def publish_model(model, model_dir=MODEL_DIR, metadata=None):
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir, exist_ok=True)
+    version, path = _claim_version(model_dir)
+    name = os.path.basename(path)
+    tmp = path+'.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(model, f)
+    os.replace(tmp, path)
+    if metadata is not None:
+        with open(os.path.join(model_dir, 'kmeans_classifier_'+version+'.txt'),'w') as f:
+            f.write('\n'.join([str(k)+' '+str(v) for k,v in sorted(metadata.items())]))
+    # Swap the pointer last so readers only ever see a fully written artifact.
+    pointer = os.path.join(model_dir, LATEST)
+    with open(pointer+'.'+version+'.tmp','w') as f:
+        f.write(name)
+    os.replace(pointer+'.'+version+'.tmp', pointer)
+    return path
+
+def latest_model_path(model_dir=MODEL_DIR, fallback=FALLBACK_MODEL):
+    try:
+        with open(os.path.join(model_dir, LATEST)) as f:
+            path = os.path.join(model_dir, f.read().strip())
+        if os.path.exists(path):
+            return path
+    except (IOError, OSError):
+        pass
+    return fallback
+
+def load_latest_model(model_dir=MODEL_DIR, fallback=FALLBACK_MODEL):
+    with open(latest_model_path(model_dir, fallback),'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retrain the address classifier from feature files.')
+    parser.add_argument('paths', nargs='+', help='whitespace separated stats files')
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=4096)
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--warm-start', action='store_true',
+                        help='continue training the latest published model')
+    args = parser.parse_args()
+
+    model = None
+    if args.warm_start:
+        model = load_latest_model(args.model_dir)
+    trainer = AddressClassifierTrainer(n_clusters=args.clusters, batch_size=args.batch_size,
+                                       chunksize=args.chunksize, n_epochs=args.epochs, model=model)
+    print('Fitting scaler...')
+    trainer.fit_scaler(args.paths)
+    print('Fitting clusters on '+str(trainer.n_samples)+' addresses...')
+    trainer.fit_kmeans(args.paths)
+    path = publish_model(trainer.pipeline(), args.model_dir,
+                         {'n_samples':trainer.n_samples,'n_clusters':trainer.n_clusters,
+                          'inertia':getattr(trainer.kmeans,'inertia_',None),'sources':','.join(args.paths)})
+    print('Published '+path)
@@ -1,5 +1,7 @@
-from flask import Flask, render_template, request, redirect
-import requests
+import os
+import re
+import math
+from flask import Flask, render_template, request, redirect, jsonify, Response, stream_with_context
 import pandas as pd
 import networkx as nx
 import pickle
@@ -10,6 +12,14 @@ import numpy as np
 
 from addrstats import BitcoinAddress, BitcoinBlock
 from BTCAddressVisualization import BTCAddressVisualization
+from addrtrainer import latest_model_path
+from addrindex import AddressIndex, INDEX_DIR
+from blockstore import BlockStore
+from graphstats import GraphStats
+import graphexport
+import singleflight
+import upstream
+from upstream import UpstreamError
 
 from sklearn import base
 from sklearn.pipeline import Pipeline
@@ -32,20 +42,23 @@ renderer = hv.renderer('bokeh')
 #%%opts Graph [color_index='label' edge_color_index='isoriginal'] (cmap='Set1' edge_cmap='viridis')
 
 app = Flask(__name__)
+blockstore = BlockStore()
 
 ###########################
 #### Bokeh Figure Code ####
 ###########################
 
-def create_figure(G,ntx):
+def create_figure(G,ntx,layout=None,maxdegree=None):
     plot = Plot(plot_width=800, plot_height=600,
                 x_range=Range1d(-1.1,1.1), y_range=Range1d(-1.1,1.1))
     #plot.title.text = "BTC Block Visualization"
 
+    if maxdegree is None:
+        maxdegree = max(list(dict(G.degree()).values()))
     citation = Label(x=0, y=-20, x_units='screen', y_units='screen',
                 text='This block contains '+str(ntx)+\
                  ' transactions between '+str(len(G.nodes()))+\
-                 ' addresses. The most active address transacted with '+str(max(list(dict(G.degree()).values())))+\
+                 ' addresses. The most active address transacted with '+str(maxdegree)+\
                  ' addresses.',
                 render_mode='css',
                 border_line_color='red', border_line_alpha=1.0,
@@ -61,7 +74,10 @@ def create_figure(G,ntx):
 
     plot.add_tools(HoverTool(tooltips=None), TapTool(), BoxSelectTool(), WheelZoomTool(), PanTool())
 
-    graph_renderer = from_networkx(G, nx.circular_layout, scale=1, center=(0,0))
+    if layout is None:
+        graph_renderer = from_networkx(G, nx.circular_layout, scale=1, center=(0,0))
+    else:
+        graph_renderer = from_networkx(G, lambda graph, **kwargs: layout)
 
     graph_renderer.node_renderer.glyph = Circle(size=4, fill_color=Spectral4[0])
     graph_renderer.node_renderer.selection_glyph = Circle(size=4, fill_color=Spectral4[2])
@@ -111,7 +127,7 @@ def get_wallet_data(wallethash):
     #w = str(wallethash)
     print(str(wallethash))
     wallet_url = str('https://blockchain.info/rawaddr/'+str(wallethash))
-    data = requests.get(wallet_url).json()
+    data = upstream.get(wallet_url).json()
     #wallet = data.json()
     return pd.DataFrame(data)['txs']
 
@@ -164,13 +180,16 @@ def make_graph(nodedata):
     return G
 
 def make_graph_ofdepth(wallet,depth):
+    #Wallets that could not be retrieved are listed in G.graph['failed']
     if depth == 0:
         try:  
             G = make_graph(get_nodes(wallet))
-            return G
-        except:
+        except UpstreamError:
+            print('Could not retrieve data from wallet ', wallet)
             G = nx.MultiDiGraph()
-            return G
+            G.graph['failed'] = [wallet]
+        G.graph.setdefault('failed', [])
+        return G
     else:
       G = make_graph_ofdepth(wallet,depth-1)
       for interactor in get_interactors_ofdepth(wallet, depth):
@@ -180,8 +199,9 @@ def make_graph_ofdepth(wallet,depth):
             for x in nodedata['Senders'][i]:
               for y in nodedata['Receivers'][i]:
                 G.add_edge(x,y)
-        except:
+        except Exception:
           print('Could not retrieve data from wallet ', interactor)
+          G.graph['failed'].append(interactor)
     return G
 
 def make_df(wallet):
@@ -214,8 +234,8 @@ def make_df_ofdepth_sampling(wallet,depth,samplesize):
                 try:
                     newdf = make_df(newwallet)
                     df = pd.concat([df,newdf.sample(n = min(newdf.shape[0],samplesize))])
-                except:
-                    pass
+                except Exception:
+                    print('Could not retrieve data from wallet ', newwallet)
         depth -= 1
     return df
 
@@ -252,6 +272,32 @@ def equalitytest_simple(wallet1, wallet2):
     return False
 
 
+#########################
+#### Model Retrieval ####
+#########################
+
+_model_cache = {}
+
+def get_model():
+    # Pick up whichever classifier addrtrainer.py last published, loading each version once.
+    path = latest_model_path()
+    if path not in _model_cache:
+        _model_cache.clear()
+        _model_cache[path] = pickle.load(open(path, 'rb'))
+    return _model_cache[path]
+
+
+_index_cache = {}
+
+def get_index():
+    # Reopen the similarity index whenever addrindex.py swaps in a rebuilt one.
+    key = os.stat(INDEX_DIR).st_ino
+    if key not in _index_cache:
+        _index_cache.clear()
+        _index_cache[key] = AddressIndex(INDEX_DIR)
+    return _index_cache[key]
+
+
 ###################
 #### MAIN BODY ####
 ###################
@@ -260,58 +306,86 @@ def equalitytest_simple(wallet1, wallet2):
 def index():
   return render_template("index2.html")
 
+def get_block_data(blockhash):
+    block_url = 'https://blockchain.info/rawblock/'+blockhash
+    return upstream.get(block_url).json()
+
+def get_latest_hash():
+    latesthash = 'https://blockchain.info/q/latesthash'
+    r = upstream.get(latesthash)
+    return str(r.text).strip()
+
+def get_parsed_block(blockhash):
+    #Concurrent requests for the same block share one fetch and parse
+    return singleflight.group('block').do(blockhash, blockstore.get_or_build, blockhash, get_block_data)
+
 @app.route('/blockplot')
 def blockplot():
     blockhash = request.args.get("blockhash")
   
     if blockhash == 'latest':
       #Retrieve the latest bloc hash from the Blockchain.info API
-      latesthash = 'https://blockchain.info/q/latesthash'
-      r = requests.get(latesthash)
-      lh = str(r.text)
-      latestblock_url = 'https://blockchain.info/rawblock/'+lh
-      data = requests.get(latestblock_url)
-      block = data.json()
-    else:
       try:
-        latestblock_url = 'https://blockchain.info/rawblock/'+blockhash
-        data = requests.get(latestblock_url)
-        block = data.json()	
-      except:
-        print('We could not retrieve block - incorrect block hash?')
+        blockhash = singleflight.group('latesthash').do('latest', get_latest_hash)
+      except UpstreamError:
+        print('We could not retrieve the latest block hash')
         return render_template('index2.html')
-    #Convert the data into a DataFrame
-    n_tx = int(block['n_tx'])
-    txseries = pd.Series(block['tx'])
-    tx = pd.DataFrame(txseries.tolist())
-    LL = [[tx['inputs'][j][i]['prev_out']['addr'] for i in range(tx['vin_sz'][j])] for j in range(1,n_tx)]
-    txin = pd.Series(LL)
-    LLL = [[tx['out'][j][i]['addr'] for i in range(tx['vout_sz'][j]) if 'addr' in tx['out'][j][i].keys()] for j in range(0,n_tx)]
-    txout = pd.Series(LLL)
-    txin.loc[-1]= ['N/A']
-    txin.index = txin.index + 1
-    txin = txin.sort_index()
-    txg_nodes = pd.DataFrame({'Senders':txin,'Receivers':txout})
+    try:
+      #Parsed blocks are shared between workers through the memory-mapped block store
+      pb = get_parsed_block(blockhash)
+    except (UpstreamError, ValueError):
+      print('We could not retrieve block - incorrect block hash?')
+      return render_template('index2.html')
 
-    #Turn the DataFrame into a networkx directed multigraph
-    G = nx.MultiDiGraph()
-    for i in range(n_tx):
-      for x in txg_nodes['Senders'][i]:
-        for y in txg_nodes['Receivers'][i]:
-          G.add_edge(x,y)
+    #Turn the stored edge arrays into a networkx directed multigraph
+    nodes = pb.address_list()
+    G = pb.graph(nodes)
+    stats = GraphStats.from_block(pb, nodes).summary()
 
-    plot = create_figure(G,n_tx)
+    plot = create_figure(G,pb.n_tx,pb.layout(nodes),stats['max_degree'])
 
     script, div = components(plot)
-    return render_template("block_plot.html", script=script, div=div)
+    return render_template("block_plot.html", script=script, div=div, stats=stats)
+
+#Wallet crawls deepen level by level until the time budget (seconds) runs out
+WALLET_BUDGET = float(os.environ.get('WALLET_BUDGET', 10))
+WALLET_MAX_BUDGET = float(os.environ.get('WALLET_MAX_BUDGET', 25))
+WALLET_MAXDEPTH = int(os.environ.get('WALLET_MAXDEPTH', 3))
+WALLET_SAMPLESIZE = int(os.environ.get('WALLET_SAMPLESIZE', 20))
+
+def get_wallet_budget():
+    try:
+        budget = float(request.args.get("budget", WALLET_BUDGET))
+    except ValueError:
+        budget = WALLET_BUDGET
+    if not math.isfinite(budget):
+        budget = WALLET_BUDGET
+    return min(max(budget, 1), WALLET_MAX_BUDGET)
+
+def build_wallet_network(w, budget):
+    viz = BTCAddressVisualization(w,WALLET_MAXDEPTH,WALLET_SAMPLESIZE,budget)
+    dftoplot = viz.networkdf()
+    return dftoplot, {'failed':viz.failed, 'partial':viz.partial,
+                      'depth':viz.depth_reached, 'partial_level':viz.partial_level, 'budget':budget}
+
+def get_wallet_network(w, budget):
+    #Concurrent requests for the same address share one crawl
+    return singleflight.group('wallet').do((w, budget), build_wallet_network, w, budget)
 
 @app.route('/walletplot')
 def walletplot():
     wallethash = request.args.get("wallethash")
     w = str(wallethash)
-    plot = BTCAddressVisualization(w,2,20).plot2()
+    try:
+        dftoplot, crawl = get_wallet_network(w, get_wallet_budget())
+    except UpstreamError:
+        print('We could not retrieve address ', w)
+        return render_template('index2.html')
+    plot = BTCAddressVisualization(w,WALLET_MAXDEPTH,WALLET_SAMPLESIZE).plot2(dftoplot)
+    stats = GraphStats.from_frame(dftoplot).summary()
     script, div = components(plot)
-    return render_template("wallet_plot.html", script=script, div=div)
+    return render_template("wallet_plot.html", script=script, div=div, failed=crawl['failed'],
+                           crawl=crawl, stats=stats)
 
 
 @app.route('/equalityresult')
@@ -325,27 +399,29 @@ def equalityresult():
 
 @app.route('/wallettype')
 def wallettype():
-    model = pickle.load(open('kmeans_classifier_addrsample_20.sav', 'rb'))
+    model = get_model()
     address = request.args.get("address")
     print(address, type(address))
     
-    #try:
-    b = BitcoinBlock(address)
+    try:
+        b = BitcoinBlock(address)
+    except UpstreamError:
+        return render_template('wallettype.html', result='Could not obtain address data')
     blockaddresses = b.get_addresses()
     blockaddrval = b.get_addrval()
-        #except:
-        #return render_template('wallettype.html', result='Could not obtain address data')
     txbal = blockaddrval[0]
     txapp = blockaddrval[1]
 
     A = []
+    failed = []
     for a in blockaddresses[0:35]:
         print('Getting data for ', a,'...')
         try:
             A.append((a,txapp[a],txbal[a],BitcoinAddress(a).stats()))
             print('...success')
-        except:
+        except Exception:
             print('...failed')
+            failed.append(a)
 
     C = [(a[0],a[1],a[2]*0.00000001,model.predict([a[3]])[0]) for a in A]
     dfraw = pd.DataFrame(C,columns=['address','appearances','balance','cluster'])
@@ -367,13 +443,197 @@ def wallettype():
     script2, div2 = components(bars_btc_plot)
 
     return render_template("blockaddrtype_plot.html", script1=script1, div1=div1,\
-                           script2=script2, div2=div2)
+                           script2=script2, div2=div2, failed=failed)
+
+
+
+MAX_GRAPHSTATS_K = 100
+
+@app.route('/graphstats')
+def graphstats():
+    blockhash = request.args.get("blockhash")
+    wallethash = request.args.get("wallethash")
+    try:
+        k = min(max(int(request.args.get("k", 10)), 1), MAX_GRAPHSTATS_K)
+        if blockhash is not None:
+            if blockhash == 'latest':
+                blockhash = singleflight.group('latesthash').do('latest', get_latest_hash)
+            stats = GraphStats.from_block(get_parsed_block(blockhash)).summary(k)
+            stats['blockhash'] = blockhash
+        elif wallethash is not None:
+            dftoplot, crawl = get_wallet_network(wallethash, get_wallet_budget())
+            stats = GraphStats.from_frame(dftoplot).summary(k)
+            stats['wallethash'] = wallethash
+            stats.update(crawl)
+        else:
+            return jsonify({'error':'blockhash or wallethash is required'}), 400
+    except ValueError as e:
+        return jsonify({'error':str(e)}), 400
+    except UpstreamError as e:
+        return jsonify({'error':str(e)}), 502
+    return jsonify(stats)
+
+MAX_SIMILAR_ADDRESSES = 35
+MAX_SIMILAR_K = 100
+
+@app.route('/similar')
+def similar():
+    address = request.args.get("address")
+    blockhash = request.args.get("blockhash")
+    asjson = request.args.get("format") == 'json'
+    try:
+        k = min(max(int(request.args.get("k", 10)), 1), MAX_SIMILAR_K)
+    except ValueError:
+        return render_template('wallettype.html', result='k must be a whole number')
+    try:
+        index = get_index()
+    except (IOError, OSError):
+        return render_template('wallettype.html', result='The similar address index has not been built')
+    if address:
+        queries = [address]
+    elif blockhash:
+        try:
+            pb = get_parsed_block(blockhash)
+        except (UpstreamError, ValueError):
+            return render_template('wallettype.html', result='Could not obtain block data')
+        queries = [a for a in pb.address_list() if a != 'N/A']
+    else:
+        return render_template('index2.html')
 
+    #Indexed addresses reuse their stored vectors; only the others are fetched upstream,
+    #at most MAX_SIMILAR_ADDRESSES of them per request
+    A = []
+    failed = []
+    skipped = []
+    fetched = 0
+    for a, row in zip(queries, index.find(queries)):
+        if row >= 0:
+            A.append((a,index.vectors[row]))
+            continue
+        if fetched == MAX_SIMILAR_ADDRESSES:
+            skipped.append(a)
+            continue
+        fetched += 1
+        try:
+            A.append((a,index.transform([BitcoinAddress(a).stats()])[0]))
+        except Exception:
+            print('Could not retrieve data for ', a)
+            failed.append(a)
+    if not A:
+        return render_template('wallettype.html', result='Could not obtain address data')
+
+    #One batch query for all addresses; an indexed query address is dropped from its own results
+    labels, distances = index.search_vectors([a[1] for a in A], k+1)
+    results = [{'address':a[0],
+                'similar':[{'address':l, 'distance':float(d)} for l,d in zip(L,D)
+                           if l is not None and l != a[0]][0:k]}
+               for a,L,D in zip(A,labels,distances)]
+    if asjson:
+        return jsonify({'results':results, 'failed':failed, 'skipped':skipped})
+    return render_template('similar.html', results=results, failed=failed, skipped=skipped)
 
+###########################
+#### Bulk Graph Export ####
+###########################
+
+MAX_EXPORT_BLOCKS = 1000
+ADDRESS_RE = re.compile('^[A-Za-z0-9]{25,90}$')
+
+def export_response(chunks, fmt, filename):
+    headers = {'Content-Disposition':'attachment; filename="'+filename+'.'+fmt+'"'}
+    return Response(stream_with_context(chunks), mimetype=graphexport.MIMETYPES[fmt], headers=headers)
+
+def get_block_at_height(height):
+    block_url = 'https://blockchain.info/block-height/'+str(height)+'?format=json'
+    blocks = upstream.get(block_url).json()['blocks']
+    block = [b for b in blocks if b.get('main_chain', True)][0]
+    blockstore.set_hash_at(height, block['hash'])
+    return block
+
+def get_parsed_block_at_height(height):
+    #Heights seen before go straight to the store by hash
+    blockhash = blockstore.hash_at(height)
+    if blockhash is not None:
+        return blockhash, get_parsed_block(blockhash)
+    #The block-height API returns full blocks, so they go straight into the store
+    block = singleflight.group('height').do(height, get_block_at_height, height)
+    blockhash = block['hash']
+    return blockhash, singleflight.group('block').do(blockhash, blockstore.get_or_build, blockhash, lambda h: block)
+
+@app.route('/export/block')
+def export_block():
+    blockhash = request.args.get("blockhash", "")
+    fmt = request.args.get("format", "npz")
+    table = request.args.get("table", "edges")
+    try:
+        if blockhash == 'latest':
+            blockhash = singleflight.group('latesthash').do('latest', get_latest_hash)
+        edges, nodes = graphexport.block_tables(get_parsed_block(blockhash))
+        chunks = graphexport.stream_tables(edges, nodes, fmt, table)
+    except ValueError as e:
+        return jsonify({'error':str(e)}), 400
+    except UpstreamError as e:
+        return jsonify({'error':str(e)}), 502
+    return export_response(chunks, fmt, 'block_'+blockhash+'_'+table)
+
+@app.route('/export/wallet')
+def export_wallet():
+    wallethash = request.args.get("wallethash", "")
+    fmt = request.args.get("format", "npz")
+    table = request.args.get("table", "edges")
+    if not ADDRESS_RE.match(wallethash):
+        return jsonify({'error':'Not a wallet address: '+repr(wallethash)}), 400
+    try:
+        dftoplot, crawl = get_wallet_network(wallethash, get_wallet_budget())
+        edges, nodes = graphexport.frame_tables(dftoplot)
+        chunks = graphexport.stream_tables(edges, nodes, fmt, table)
+    except ValueError as e:
+        return jsonify({'error':str(e)}), 400
+    except UpstreamError as e:
+        return jsonify({'error':str(e)}), 502
+    response = export_response(chunks, fmt, 'wallet_'+wallethash+'_'+table)
+    response.headers['X-Incomplete-Addresses'] = str(len(crawl['failed']))
+    response.headers['X-Partial-Crawl'] = str(crawl['partial']).lower()
+    return response
+
+@app.route('/export/blocks')
+def export_blocks():
+    #NDJSON edges for many blocks, given either as blockhashes=h1,h2,... or as start=<height>&count=<n>
+    blockhashes = [h for h in request.args.get("blockhashes", "").split(',') if h]
+    try:
+        start = int(request.args.get("start", -1))
+        count = min(int(request.args.get("count", 1)), MAX_EXPORT_BLOCKS)
+    except ValueError as e:
+        return jsonify({'error':str(e)}), 400
+    keys = blockhashes[:MAX_EXPORT_BLOCKS] if blockhashes else list(range(start, start+count)) if start >= 0 else []
+    if not keys:
+        return jsonify({'error':'blockhashes or start is required'}), 400
+
+    def records():
+        #Bulk exports queue behind interactive page requests for upstream slots
+        with upstream.priority(upstream.BULK):
+            for key in keys:
+                try:
+                    if isinstance(key, int):
+                        blockhash, pb = get_parsed_block_at_height(key)
+                    else:
+                        blockhash, pb = key, get_parsed_block(key)
+                except (UpstreamError, ValueError, KeyError, IndexError) as e:
+                    yield {'block':key, 'error':str(e)}
+                    continue
+                edges, nodes = graphexport.block_tables(pb)
+                for record in graphexport.ndjson_records(edges, nodes, blockhash=blockhash):
+                    yield record
+
+    return export_response(graphexport.stream_ndjson(records()), 'ndjson', 'blocks')
+
+@app.route('/metrics')
+def metrics():
+    return jsonify({'singleflight':singleflight.stats(), 'upstream':upstream.stats()})
 
 @app.route('/about')
 def about():
   return render_template('about_simple.html')
 
 if __name__ == '__main__':
-  app.run(port=33507, debug=True)
+  app.run(port=33507, debug=True, threaded=True)
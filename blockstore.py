@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import shutil
+import fcntl
+import tempfile
+import numpy as np
+import networkx as nx
+
+BLOCKSTORE_DIR = os.environ.get('BLOCKSTORE_DIR', os.path.join(tempfile.gettempdir(), 'btc_blockstore'))
+BLOCKSTORE_MAX_BYTES = int(float(os.environ.get('BLOCKSTORE_MAX_MB', 512)) * 2**20)
+STALE_SECONDS = 3600
+BLOCKHASH_RE = re.compile('^[0-9a-fA-F]{64}$')
+ARRAYS = ['addresses','src','dst','value','pos','meta']
+FORMAT_VERSION = 2
+HEIGHTS = '.heights'
+
+
+#######################
+#### Block Parsing ####
+#######################
+
+def circular_positions(n):
+    # Same placement as nx.circular_layout(G, scale=1, center=(0,0)).
+    if n == 1:
+        return np.zeros((1,2))
+    theta = np.linspace(0, 1, n+1)[:-1] * 2 * np.pi
+    return np.column_stack([np.cos(theta), np.sin(theta)])
+
+def parse_block(block):
+    # Flattens a rawblock into an interned address table plus edge index arrays.
+    # Addresses are numbered in the order networkx would add them to the block graph,
+    # and the coinbase transaction is given the sender 'N/A' as in /blockplot.
+    # Each output is split across the transaction's inputs in proportion to their
+    # prev_out values, so summing edge values gives the satoshis actually moved.
+    index = {}
+    src, dst, value = [], [], []
+    txs = block['tx']
+    for j in range(int(block['n_tx'])):
+        tx = txs[j]
+        if j == 0:
+            senders = [('N/A',1)]
+        else:
+            senders = [(i['prev_out']['addr'],i['prev_out'].get('value',0)) for i in tx['inputs']
+                       if 'prev_out' in i and 'addr' in i['prev_out']]
+        receivers = [(o['addr'],o.get('value',0)) for o in tx['out'] if 'addr' in o]
+        total_in = sum(w for x,w in senders)
+        for x,w in senders:
+            share = float(w) / total_in if total_in > 0 else 1.0 / len(senders)
+            for y,v in receivers:
+                if x not in index:
+                    index[x] = len(index)
+                if y not in index:
+                    index[y] = len(index)
+                src.append(index[x])
+                dst.append(index[y])
+                value.append(v * share)
+    addresses = sorted(index, key=index.get)
+    return {'addresses':np.array(addresses, dtype='S') if addresses else np.zeros(0, dtype='S1'),
+            'src':np.array(src, dtype=np.int32),
+            'dst':np.array(dst, dtype=np.int32),
+            'value':np.array(value, dtype=np.float64),
+            'pos':circular_positions(len(addresses)),
+            'meta':np.array([int(block['n_tx']), FORMAT_VERSION], dtype=np.int64)}
+
+
+#######################
+#### Parsed Blocks ####
+#######################
+
+class ParsedBlock():
+
+    def __init__(self, arrays):
+        self.addresses = arrays['addresses']
+        self.src = arrays['src']
+        self.dst = arrays['dst']
+        self.value = arrays['value']
+        self.pos = arrays['pos']
+        self.n_tx = int(arrays['meta'][0])
+        self.version = int(arrays['meta'][1]) if len(arrays['meta']) > 1 else 1
+
+    @classmethod
+    def open(cls, path):
+        # Arrays are memory mapped read only, so every worker shares the same pages.
+        return cls(dict((name, np.load(os.path.join(path, name+'.npy'), mmap_mode='r'))
+                        for name in ARRAYS))
+
+    def n_nodes(self):
+        return len(self.addresses)
+
+    def address_list(self):
+        return [a.decode() for a in self.addresses]
+
+    def graph(self, nodes=None):
+        if nodes is None:
+            nodes = self.address_list()
+        G = nx.MultiDiGraph()
+        G.add_nodes_from(nodes)
+        G.add_edges_from(zip([nodes[i] for i in self.src], [nodes[i] for i in self.dst]))
+        return G
+
+    def layout(self, nodes=None):
+        if nodes is None:
+            nodes = self.address_list()
+        return dict(zip(nodes, np.asarray(self.pos)))
+
+
+#####################
+#### Block Store ####
+#####################
+
+class BlockStore():
+
+    def __init__(self, root=BLOCKSTORE_DIR, max_open=64, max_bytes=BLOCKSTORE_MAX_BYTES):
+        self.root = root
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.opened = {}
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blockhash):
+        if not BLOCKHASH_RE.match(blockhash):
+            raise ValueError('Not a block hash: '+repr(blockhash))
+        return os.path.join(self.root, blockhash.lower())
+
+    def get(self, blockhash):
+        path = self.path(blockhash)
+        if path in self.opened and os.path.exists(path):
+            self._touch(path)
+            return self.opened[path]
+        self.opened.pop(path, None)
+        if not os.path.exists(os.path.join(path, 'meta.npy')):
+            return None
+        pb = ParsedBlock.open(path)
+        self._touch(path)
+        if pb.version != FORMAT_VERSION:
+            return None
+        if len(self.opened) >= self.max_open:
+            self.opened.pop(next(iter(self.opened)))
+        self.opened[path] = pb
+        return pb
+
+    def put(self, blockhash, block):
+        path = self.path(blockhash)
+        arrays = parse_block(block)
+        # Write into a private directory and rename it into place, so readers never
+        # see a half written block.
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp_')
+        try:
+            for name in ARRAYS:
+                np.save(os.path.join(tmp, name+'.npy'), arrays[name])
+            if os.path.exists(path):
+                # A block written in an older format; move it aside before replacing it.
+                stale = tempfile.mkdtemp(dir=self.root, prefix='.tmp_')
+                os.rename(path, os.path.join(stale, 'block'))
+                shutil.rmtree(stale, ignore_errors=True)
+            os.rename(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(os.path.join(path, 'meta.npy')):
+                raise
+        return self.get(blockhash)
+
+    def hash_at(self, height):
+        # Block hashes recorded by height, so a bulk export only asks upstream for the
+        # block-height listing of heights it has not seen.
+        try:
+            with open(os.path.join(self.root, HEIGHTS, str(int(height)))) as f:
+                blockhash = f.read().strip()
+        except (IOError, OSError):
+            return None
+        return blockhash if BLOCKHASH_RE.match(blockhash) else None
+
+    def set_hash_at(self, height, blockhash):
+        self.path(blockhash)
+        heights = os.path.join(self.root, HEIGHTS)
+        if not os.path.isdir(heights):
+            os.makedirs(heights, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=heights, prefix='.tmp_')
+        with os.fdopen(fd, 'w') as f:
+            f.write(blockhash.lower())
+        os.replace(tmp, os.path.join(heights, str(int(height))))
+
+    def get_or_build(self, blockhash, fetch):
+        pb = self.get(blockhash)
+        if pb is not None:
+            return pb
+        # Only one worker fetches and parses a given block; the others wait on the
+        # lock and then open what it wrote. The lock file is removed once the block is
+        # written, so a waiter whose file was unlinked in the meantime starts over.
+        lockpath = self.path(blockhash)+'.lock'
+        while True:
+            lock = open(lockpath, 'w')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(lockpath).st_ino:
+                    break
+            except OSError:
+                pass
+            lock.close()
+        try:
+            pb = self.get(blockhash)
+            if pb is None:
+                pb = self.put(blockhash, fetch(blockhash))
+                self.evict(keep=self.path(blockhash))
+        finally:
+            try:
+                os.unlink(lockpath)
+            except OSError:
+                pass
+            lock.close()
+        return pb
+
+    def _touch(self, path):
+        # Directory mtimes order blocks for eviction, least recently used first.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        # Rename first so the block disappears atomically; workers that already
+        # mapped its arrays keep their pages until they drop them.
+        try:
+            trash = tempfile.mkdtemp(dir=self.root, prefix='.tmp_')
+            os.rename(path, os.path.join(trash, 'block'))
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def evict(self, keep=None):
+        now = time.time()
+        blocks = []
+        total = 0
+        for entry in os.listdir(self.root):
+            path = os.path.join(self.root, entry)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if entry.startswith('.tmp_') or entry.endswith('.lock'):
+                # Left behind by a worker that died mid-write.
+                if now - mtime > STALE_SECONDS:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                continue
+            if not BLOCKHASH_RE.match(entry) or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            blocks.append((mtime, path, size))
+            total += size
+        for mtime, path, size in sorted(blocks):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self._remove(path)
+            self.opened.pop(path, None)
+            total -= size
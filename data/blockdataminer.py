@@ -22,6 +22,7 @@ for day in days:
 sample = [x for y in blockhashes.values() for x in y]
 
 addr_stats = []
+addr_labeled = []
 
 for blockhash in sample:
     print('Scouring '+blockhash+ ' for addresses...')
@@ -37,7 +38,8 @@ for blockhash in sample:
                     a = BitcoinAddress(addr)
                     with open('address_'+a.addrkey+'.json','w') as f:
                         json.dump(a.address, f)  
-                    addr_stats.append(BitcoinAddress(addr).stats())
+                    addr_stats.append(a.stats())
+                    addr_labeled.append((addr,)+addr_stats[-1])
                 except:
                     print('...failed')
         except:
@@ -48,3 +50,7 @@ for blockhash in sample:
 with open('stats.txt','w') as f:
     f.write('\n'.join([' '.join(map(str,x)) for x in addr_stats]))
 
+#Address-first rows, for building the similar address index with addrindex.py
+with open('stats_labeled.txt','w') as f:
+    f.write('\n'.join([' '.join(map(str,x)) for x in addr_labeled]))
+
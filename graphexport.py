@@ -0,0 +1,185 @@
+import json
+import zipfile
+import numpy as np
+
+from graphstats import GraphStats, intern_edges
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+FORMATS = ['npz','arrow','parquet','ndjson']
+TABLES = ['edges','nodes']
+MIMETYPES = {'npz':'application/zip',
+             'arrow':'application/vnd.apache.arrow.stream',
+             'parquet':'application/octet-stream',
+             'ndjson':'application/x-ndjson'}
+CHUNKSIZE = 65536
+
+
+class _Sink():
+    # A write-only file object whose contents are handed out piecewise by drain(),
+    # so writers that expect a file can feed a streaming response.
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+######################
+#### Graph Tables ####
+######################
+
+def graph_tables(src, dst, value, nodes, pos=None):
+    stats = GraphStats(src, dst, len(nodes), value, nodes)
+    edges = {'src':np.asarray(src, dtype=np.int32),
+             'dst':np.asarray(dst, dtype=np.int32),
+             'value':np.asarray(value, dtype=np.float64)}
+    nodetable = {'id':np.arange(len(nodes), dtype=np.int32),
+                 'address':np.array(nodes, dtype=object),
+                 'in_degree':stats.in_degree().astype(np.int64),
+                 'out_degree':stats.out_degree().astype(np.int64),
+                 'in_flow':stats.in_flow(),
+                 'out_flow':stats.out_flow(),
+                 'component':stats.components()[1].astype(np.int32)}
+    if pos is not None:
+        pos = np.asarray(pos)
+        nodetable['x'] = pos[:,0]
+        nodetable['y'] = pos[:,1]
+    return edges, nodetable
+
+def block_tables(pb):
+    return graph_tables(pb.src, pb.dst, pb.value, pb.address_list(), pb.pos)
+
+def frame_tables(df, sender='Sender', recipient='Recipient', value='Transferred'):
+    nodes, src, dst = intern_edges(df[sender].tolist(), df[recipient].tolist())
+    return graph_tables(src, dst, df[value].values, nodes)
+
+
+###################
+#### Streaming ####
+###################
+
+def stream_npz(edges, nodes, chunksize=CHUNKSIZE):
+    # Arrays are written one slice at a time into a zip on a non-seekable stream,
+    # which np.load reads back as edges_<column> and nodes_<column>.
+    sink = _Sink()
+    zf = zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+    for prefix, table in [('edges',edges),('nodes',nodes)]:
+        for name, arr in table.items():
+            if arr.dtype == object:
+                arr = arr.astype('U') if len(arr) else np.zeros(0, dtype='U1')
+            with zf.open(prefix+'_'+name+'.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_1_0(f, np.lib.format.header_data_from_array_1_0(arr))
+                for start in range(0, len(arr), chunksize):
+                    f.write(np.ascontiguousarray(arr[start:start+chunksize]).tobytes())
+                    yield sink.drain()
+            yield sink.drain()
+    zf.close()
+    yield sink.drain()
+
+def _record_batches(table, nodes, chunksize):
+    n = len(next(iter(table.values())))
+    for start in range(0, max(n, 1), chunksize):
+        columns = dict((name, arr[start:start+chunksize]) for name, arr in table.items())
+        if 'src' in columns:
+            columns['sender'] = nodes['address'][columns['src']]
+            columns['recipient'] = nodes['address'][columns['dst']]
+        yield pa.RecordBatch.from_arrays([pa.array(arr) for arr in columns.values()],
+                                         list(columns.keys()))
+
+def stream_arrow(table, nodes, chunksize=CHUNKSIZE):
+    sink = _Sink()
+    writer = None
+    for batch in _record_batches(table, nodes, chunksize):
+        if writer is None:
+            writer = pa.RecordBatchStreamWriter(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def stream_parquet(table, nodes, chunksize=CHUNKSIZE):
+    sink = _Sink()
+    writer = None
+    for batch in _record_batches(table, nodes, chunksize):
+        if writer is None:
+            writer = pq.ParquetWriter(sink, batch.schema)
+        writer.write_table(pa.Table.from_batches([batch]))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def ndjson_records(edges, nodes, **extra):
+    address = nodes['address']
+    for start in range(0, len(edges['src']), CHUNKSIZE):
+        src = edges['src'][start:start+CHUNKSIZE].tolist()
+        dst = edges['dst'][start:start+CHUNKSIZE].tolist()
+        value = edges['value'][start:start+CHUNKSIZE].tolist()
+        for s, d, v in zip(src, dst, value):
+            record = {'sender':address[s], 'recipient':address[d], 'value':v}
+            record.update(extra)
+            yield record
+
+def node_records(nodes):
+    keys = list(nodes.keys())
+    for start in range(0, len(nodes['id']), CHUNKSIZE):
+        columns = [nodes[k][start:start+CHUNKSIZE].tolist() for k in keys]
+        for row in zip(*columns):
+            yield dict(zip(keys, row))
+
+def stream_ndjson(records):
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record))
+        if len(lines) == 1000:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def stream_tables(edges, nodes, fmt, table='edges'):
+    # npz always carries both tables; the other formats carry the one named by table.
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: '+repr(fmt))
+    if table not in TABLES:
+        raise ValueError('Unknown export table: '+repr(table))
+    if fmt == 'npz':
+        return stream_npz(edges, nodes)
+    if fmt == 'ndjson':
+        if table == 'nodes':
+            return stream_ndjson(node_records(nodes))
+        return stream_ndjson(ndjson_records(edges, nodes))
+    if pa is None:
+        raise ValueError('pyarrow is required for '+fmt+' export')
+    data = nodes if table == 'nodes' else edges
+    if fmt == 'arrow':
+        return stream_arrow(data, nodes)
+    return stream_parquet(data, nodes)
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def intern_edges(senders, recipients):
+    # Maps address labels to dense integer ids, numbering senders before recipients.
+    codes, nodes = pd.factorize(pd.Series(list(senders) + list(recipients)))
+    return list(nodes), codes[:len(senders)], codes[len(senders):]
+
+
+class GraphStats():
+
+    def __init__(self, src, dst, n, value=None, nodes=None):
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        if value is None:
+            value = np.zeros(len(src))
+        self.n = n
+        self.n_edges = len(src)
+        self.nodes = nodes
+        # Parallel edges are summed, so A holds edge multiplicities and W the value moved.
+        self.A = sparse.coo_matrix((np.ones(len(src)), (src, dst)), shape=(n, n)).tocsr()
+        self.W = sparse.coo_matrix((np.asarray(value, dtype=np.float64), (src, dst)), shape=(n, n)).tocsr()
+
+    @classmethod
+    def from_block(cls, pb, nodes=None):
+        if nodes is None:
+            nodes = pb.address_list()
+        return cls(pb.src, pb.dst, pb.n_nodes(), pb.value, nodes)
+
+    @classmethod
+    def from_frame(cls, df, sender='Sender', recipient='Recipient', value='Transferred'):
+        nodes, src, dst = intern_edges(df[sender].tolist(), df[recipient].tolist())
+        return cls(src, dst, len(nodes), df[value].values if value in df else None, nodes)
+
+    def out_degree(self):
+        return np.asarray(self.A.sum(axis=1)).ravel()
+
+    def in_degree(self):
+        return np.asarray(self.A.sum(axis=0)).ravel()
+
+    def degree(self):
+        # Same count as networkx's MultiDiGraph.degree(): self loops count twice.
+        return self.out_degree() + self.in_degree()
+
+    def out_flow(self):
+        return np.asarray(self.W.sum(axis=1)).ravel()
+
+    def in_flow(self):
+        return np.asarray(self.W.sum(axis=0)).ravel()
+
+    def components(self):
+        return connected_components(self.A, directed=True, connection='weak')
+
+    def pagerank(self, alpha=0.85, tol=1e-8, max_iter=100):
+        if self.n == 0:
+            return np.zeros(0)
+        out = self.out_degree()
+        dangling = out == 0
+        inv = np.where(dangling, 0, 1 / np.where(dangling, 1, out))
+        P = sparse.diags(inv).dot(self.A).T.tocsr()
+        r = np.full(self.n, 1.0 / self.n)
+        for _ in range(max_iter):
+            r_new = alpha * (P.dot(r) + r[dangling].sum() / self.n) + (1 - alpha) / self.n
+            if np.abs(r_new - r).sum() < self.n * tol:
+                return r_new
+            r = r_new
+        return r
+
+    def top_k(self, k=10, by=None):
+        if by is None:
+            by = self.degree()
+        k = max(0, min(k, self.n))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.argpartition(-by, k - 1)[:k]
+        return idx[np.argsort(-by[idx], kind='mergesort')]
+
+    def summary(self, k=10):
+        in_degree = self.in_degree()
+        out_degree = self.out_degree()
+        degree = in_degree + out_degree
+        out_flow = self.out_flow()
+        in_flow = self.in_flow()
+        rank = self.pagerank()
+        n_components, labels = self.components()
+        sizes = np.bincount(labels) if self.n else np.zeros(0, dtype=np.int64)
+        top = [{'address': self.nodes[i] if self.nodes is not None else int(i),
+                'degree': int(degree[i]),
+                'in_degree': int(in_degree[i]),
+                'out_degree': int(out_degree[i]),
+                'btc_sent': float(out_flow[i]) * 0.00000001,
+                'btc_received': float(in_flow[i]) * 0.00000001,
+                'pagerank': float(rank[i])} for i in self.top_k(k, degree)]
+        return {'n_nodes': int(self.n),
+                'n_edges': int(self.n_edges),
+                'n_components': int(n_components),
+                'largest_component': int(sizes.max()) if len(sizes) else 0,
+                'max_degree': int(degree.max()) if self.n else 0,
+                'top': top}
@@ -0,0 +1,68 @@
+import threading
+
+
+class _Call():
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        # The first caller for a key runs fn; concurrent callers for the same key
+        # wait for it and share its result (or its exception).
+        with self.lock:
+            call = self.inflight.get(key)
+            if call is None:
+                call = _Call()
+                self.inflight[key] = call
+                self.executed += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'executed':self.executed, 'coalesced':self.coalesced,
+                    'in_flight':len(self.inflight)}
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+def group(name):
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+def stats():
+    with _groups_lock:
+        groups = list(_groups.values())
+    return dict((g.name, g.stats()) for g in groups)
@@ -0,0 +1,242 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from contextlib import contextmanager
+
+import requests
+
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, message, url=None, status=None):
+        Exception.__init__(self, message)
+        self.url = url
+        self.status = status
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+#######################
+#### Rate Limiting ####
+#######################
+
+class TokenBucket():
+
+    def __init__(self, rate, burst, min_rate=None):
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate is not None else self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return now
+
+    def acquire(self, priority=INTERACTIVE, deadline=None):
+        # Waiters are served strictly by priority class, then in arrival order, so an
+        # interactive request jumps ahead of queued background and bulk work.
+        with self.cond:
+            me = (priority, next(self.counter))
+            heapq.heappush(self.waiters, me)
+            try:
+                while True:
+                    now = self._refill()
+                    if self.waiters[0] == me and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    if deadline is not None and now >= deadline:
+                        return False
+                    wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.05
+                    if deadline is not None:
+                        wait = min(wait, deadline - now)
+                    self.cond.wait(max(wait, 0.001))
+            finally:
+                self.waiters.remove(me)
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    def slow_down(self):
+        # Multiplicative decrease when upstream pushes back, additive increase otherwise.
+        with self.cond:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.cond:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+#########################
+#### Circuit Breaker ####
+#########################
+
+class CircuitBreaker():
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = 'closed'
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let a single probe through; its outcome closes or reopens the circuit.
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = 'closed'
+
+    def release(self):
+        # A half-open probe that ended without an upstream response (a deadline, or an
+        # unexpected error) hands the circuit back to open so the next caller can probe.
+        with self.lock:
+            if self.state == 'half-open':
+                self.state = 'open'
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+############################
+#### Upstream Scheduler ####
+############################
+
+class UpstreamScheduler():
+
+    def __init__(self, rate=2, burst=5, max_retries=4, backoff_base=0.5, backoff_cap=30,
+                 timeout=20, failure_threshold=5, reset_timeout=30):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {'requests':0, 'retries':0, 'throttled':0, 'failures':0, 'rejected':0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    @contextmanager
+    def priority(self, priority):
+        previous = getattr(self.local, 'priority', INTERACTIVE)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def backoff(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(self.backoff_cap, float(response.headers['Retry-After']))
+        # Full jitter: spreads retries from many workers over the whole backoff window.
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def get(self, url, priority=None, deadline=None, **kwargs):
+        # deadline is a time.monotonic() value after which no further attempt is made.
+        if priority is None:
+            priority = getattr(self.local, 'priority', INTERACTIVE)
+        kwargs.setdefault('timeout', self.timeout)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                self._count('rejected')
+                raise CircuitOpenError('Upstream circuit is open', url)
+            settled = False
+            try:
+                if not self.bucket.acquire(priority, deadline):
+                    raise UpstreamError('Deadline passed waiting for an upstream slot', url)
+                if deadline is not None:
+                    kwargs['timeout'] = max(0.1, min(kwargs['timeout'], deadline - time.monotonic()))
+                self._count('requests')
+                response = None
+                try:
+                    response = self.session.get(url, **kwargs)
+                except requests.RequestException as e:
+                    error = UpstreamError(str(e), url)
+                else:
+                    if response.status_code not in RETRY_STATUS:
+                        self.breaker.record_success()
+                        settled = True
+                        self.bucket.speed_up()
+                        if response.status_code >= 400:
+                            raise UpstreamError('Upstream returned '+str(response.status_code),
+                                                url, response.status_code)
+                        return response
+                    error = UpstreamError('Upstream returned '+str(response.status_code),
+                                          url, response.status_code)
+                    if response.status_code == 429:
+                        self._count('throttled')
+                        self.bucket.slow_down()
+                self.breaker.record_failure()
+                settled = True
+            finally:
+                if not settled:
+                    self.breaker.release()
+            if attempt == self.max_retries:
+                break
+            delay = self.backoff(attempt, response)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                break
+            self._count('retries')
+            time.sleep(delay)
+        self._count('failures')
+        raise error
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        counts['rate'] = self.bucket.rate
+        counts['circuit'] = self.breaker.state
+        return counts
+
+
+# UPSTREAM_RATE is the budget for the whole dyno; each of its WEB_CONCURRENCY worker
+# processes keeps its own bucket, so it gets an equal share.
+WORKERS = max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1)
+scheduler = UpstreamScheduler(rate=float(os.environ.get('UPSTREAM_RATE', 2)) / WORKERS,
+                              burst=max(float(os.environ.get('UPSTREAM_BURST', 5)) / WORKERS, 1))
+
+def get(url, priority=None, deadline=None, **kwargs):
+    return scheduler.get(url, priority, deadline, **kwargs)
+
+def priority(priority):
+    return scheduler.priority(priority)
+
+def stats():
+    return scheduler.stats()